@@ -5,8 +5,8 @@ Convert gperftools cpu profiler result to flamegraph.
 """
 
 import argparse
-import collections
 import logging
+import mmap
 import typing as tp
 import struct
 import dataclasses
@@ -15,55 +15,88 @@ from pathlib import Path
 from utils import SymbolResolver, FlamegraphData
 
 
-@dataclasses.dataclass
-class Stacktrace:
-    sample_count: int
-    pcs: tp.Tuple[int]
-    symbols: tp.Optional[tp.List[str]] = None
-
 @dataclasses.dataclass
 class ProfilerResult:
+    __slots__ = ('sampling_period_in_us', 'proc_mapped_objects', 'stacktraces')
+
     sampling_period_in_us: int
     proc_mapped_objects: str
-    stacktraces: tp.List[Stacktrace]
+    # pcs of a stacktrace -> summed sample count of the records with exactly these pcs.
+    stacktraces: tp.Dict[tp.Tuple[int], int]
 
 _UNKNOWN_SYMBOL = '???'
 
-def _parse_profiler_result(filepath: Path):
-    f = filepath.open('rb')
-
-    def read_slots(n):
-        # 64 bit slots
-        return struct.unpack('Q' * n, f.read(8 * n))
-    
-    header_count, header_slots, version, sampling_period_in_us, padding = read_slots(5)
-    assert(
-        header_count == 0 and header_slots == 3 and version == 0 and padding == 0
-    ), 'Invalid header, this profiler result is not valid'
-
-    result = ProfilerResult(
-        sampling_period_in_us=sampling_period_in_us,
-        proc_mapped_objects='',
-        stacktraces=[],
-    )
+class _StackNode:
+    """
+    A frame in the call tree, count is the number of samples ending right at this frame.
+    """
+
+    __slots__ = ('count', 'children')
+
+    count: int
+    children: tp.Dict[str, '_StackNode']
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.children = {}
+
+    def collect_stacks(self) -> tp.Dict[str, int]:
+        """
+        Flatten the tree below this node to "outer;...;inner" -> count.
+        """
+        stacks: tp.Dict[str, int] = {}
+        path: tp.List[str] = []
+        # depth first, the iterator of each level is kept on the stack together with the path.
+        pending = [iter(self.children.items())]
+        while pending:
+            item = next(pending[-1], None)
+            if item is None:
+                pending.pop()
+                if path:
+                    path.pop()
+                continue
+            symbol, node = item
+            path.append(symbol)
+            if node.count:
+                # different paths join to the same key when a symbol contains ';', so add up.
+                key = ';'.join(path)
+                stacks[key] = stacks.get(key, 0) + node.count
+            pending.append(iter(node.children.items()))
 
-    # reader profiler records and binary trailer
-    while True:
-        sample_count, num_pcs = read_slots(2)
-        pcs = read_slots(num_pcs)
+        return stacks
 
-        if sample_count == 0:
-            assert num_pcs == 1, 'Invalid trailer'
-            break
+# header_count, header_slots, version, sampling_period_in_us, padding
+_HEADER = struct.Struct('5Q')
 
-        result.stacktraces.append(
-            Stacktrace(
-                sample_count=sample_count,
-                pcs=pcs,
-            )
+def _parse_profiler_result(filepath: Path):
+    with filepath.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        header_count, header_slots, version, sampling_period_in_us, padding = _HEADER.unpack_from(mm, 0)
+        assert(
+            header_count == 0 and header_slots == 3 and version == 0 and padding == 0
+        ), 'Invalid header, this profiler result is not valid'
+
+        result = ProfilerResult(
+            sampling_period_in_us=sampling_period_in_us,
+            proc_mapped_objects='',
+            stacktraces={},
         )
 
-    result.proc_mapped_objects = f.read().decode()
+        # 64 bit slots, the text trailer after the binary part is cut off to fit the slot size.
+        with memoryview(mm) as buf, buf[:len(mm) // 8 * 8].cast('Q') as slots:
+            # reader profiler records and binary trailer
+            i = _HEADER.size // 8
+            while True:
+                sample_count, num_pcs = slots[i], slots[i + 1]
+                pcs = tuple(slots[i + 2:i + 2 + num_pcs])
+                i += 2 + num_pcs
+
+                if sample_count == 0:
+                    assert num_pcs == 1, 'Invalid trailer'
+                    break
+
+                result.stacktraces[pcs] = result.stacktraces.get(pcs, 0) + sample_count
+
+        result.proc_mapped_objects = mm[8 * i:].decode()
 
     return result
 
@@ -86,36 +119,37 @@ class Gperf2Flamegraph:
             )
 
         # resolve symbols in profiler_result.stacktraces
-        all_pcs: tp.Set[int] = set(
-            pc for stacktrace in profiler_result.stacktraces for pc in stacktrace.pcs
-        )
+        all_pcs: tp.Set[int] = set().union(*profiler_result.stacktraces)
 
         pcs_to_symbols = self.symbol_resolver.resolve_symbols_batch(
             all_pcs, simplify_symbol=simplify_symbol, annotate_libname=annotate_libname
         )
-        for stacktrace in profiler_result.stacktraces:
-            stacktrace.symbols = []
-            for pc in stacktrace.pcs:
-                stacktrace.symbols.append(pcs_to_symbols.get(pc, _UNKNOWN_SYMBOL))
-
-        # collect stacks
-        stacks: tp.DefaultDict[str, int] = collections.defaultdict(lambda: 0)
-        for stacktrace in profiler_result.stacktraces:
-            if not stacktrace.symbols:
+
+        # collect stacks into a call tree, samples of the same call path share their prefix nodes.
+        root = _StackNode()
+        for pcs, sample_count in profiler_result.stacktraces.items():
+            if not pcs:
                 continue
 
-            # reverse the cpu profiler call stack to set the outer funtion in the first place.
-            symbols = stacktrace.symbols[::-1]
-            while (
-                len(symbols) > 1
-                and symbols[-1] == _UNKNOWN_SYMBOL
-            ):
-                symbols.pop()
-            stacks[';'.join(symbols)] += (
-                stacktrace.sample_count * profiler_result.sampling_period_in_us
-                if to_microsecond else stacktrace.sample_count
+            # skip the unresolved innermost frames, but keep at least the outermost one.
+            begin = 0
+            while begin < len(pcs) - 1 and pcs[begin] not in pcs_to_symbols:
+                begin += 1
+            node = root
+            # walk the cpu profiler call stack backwards to set the outer funtion in the first place.
+            for i in range(len(pcs) - 1, begin - 1, -1):
+                symbol = pcs_to_symbols.get(pcs[i], _UNKNOWN_SYMBOL)
+                child = node.children.get(symbol)
+                if child is None:
+                    child = node.children[symbol] = _StackNode()
+                node = child
+            node.count += (
+                sample_count * profiler_result.sampling_period_in_us
+                if to_microsecond else sample_count
             )
 
+        stacks = root.collect_stacks()
+
         return FlamegraphData(
             stacks, default_flamegraph_args=['--countname', 'us'] if to_microsecond else []
         )
@@ -1,96 +1,352 @@
 #!/usr/bin/env python3
 
+import array
 import bisect
+import concurrent.futures
 import dataclasses
+import hashlib
+import json
+import mmap
 import os
 from pathlib import Path
 import re
+import struct
 import subprocess
+import sys
+import threading
 import typing as tp
 
-def _remove_matching_brackets(s: str, begin='(', end=')') -> str:
-    result = ''
-    depth = 0
-    for c in s:
-        if c == begin:
-            depth == 1
-            continue
-        if c == end:
-            depth -= 1
-            continue
-        if depth == 0:
-            result += c
-    
-    return result
+# innermost (...), [...] and <...> groups, nested groups are peeled off one level per pass.
+_INNERMOST_BRACKETS = re.compile(r'\([^()]*\)|\[[^\[\]]*\]|<[^<>]*>')
 
 def _cleanup_symbol(s):
-    s = _remove_matching_brackets(s, '(', ')')
-    s = _remove_matching_brackets(s, '[', ']')
-    s = _remove_matching_brackets(s, '<', '>')
+    while True:
+        cleaned = _INNERMOST_BRACKETS.sub('', s)
+        if cleaned == s:
+            break
+        s = cleaned
     s = s.strip(':')
 
     return s
 
-class Symbol:
+_PT_LOAD = 1
+_PF_X = 1
+_SHT_SYMTAB = 2
+_SHT_DYNSYM = 11
+_SHT_GNU_VERDEF = 0x6ffffffd
+_SHT_GNU_VERNEED = 0x6ffffffe
+_SHT_GNU_VERSYM = 0x6fffffff
+_SHN_UNDEF = 0
+_SHN_XINDEX = 0xffff
+_STT_SECTION = 3
+_STT_FILE = 4
+_VERSYM_HIDDEN = 0x8000
+
+# ARM/AArch64 mapping symbols ($a, $d, $t, $x, optionally followed by ".<anything>"), nm hides them.
+_MAPPING_SYMBOL = re.compile(r'\$[adtx](\..*)?')
+
+@dataclasses.dataclass
+class _ElfSection:
+    name: str
+    type: int
+    addr: int
+    offset: int
+    size: int
+    link: int
+
+
+class _ElfFile:
     """
-    This class represents single symbol(function) in the process
+    Minimal ELF reader over a mmap of the file, only the program headers, the section headers
+    and the symbol tables are parsed.
     """
 
-    address: int
-    symbol: str
-    _cleaned_symbol: tp.Optional[str]
+    def __init__(self, mm: mmap.mmap) -> None:
+        if mm[:4] != b'\x7fELF':
+            raise ValueError('not an ELF file')
+        is_64bit = mm[4] == 2
+        endian = '<' if mm[5] == 1 else '>'
+        if is_64bit:
+            header = struct.Struct(f'{endian}16xHHIQQQIHHHHHH')
+            # p_type, p_flags, p_offset, p_vaddr
+            program_header = struct.Struct(f'{endian}IIQQ')
+            self._section_header = struct.Struct(f'{endian}IIQQQQIIQQ')
+            # st_name, st_info, st_shndx, st_value (st_other and st_size are skipped)
+            self._symbol = struct.Struct(f'{endian}IBxHQ8x')
+        else:
+            header = struct.Struct(f'{endian}16xHHIIIIIHHHHHH')
+            # p_type, p_offset, p_vaddr, p_paddr, p_filesz, p_memsz, p_flags
+            program_header = struct.Struct(f'{endian}IIIIIII')
+            self._section_header = struct.Struct(f'{endian}IIIIIIIIII')
+            # st_name, st_value, st_info, st_shndx (st_size and st_other are skipped)
+            self._symbol = struct.Struct(f'{endian}II4xBxH')
+        self._is_64bit = is_64bit
+        self._endian = endian
+        self._mm = mm
+
+        _, _, _, _, phoff, shoff, _, _, phentsize, phnum, _, shnum, shstrndx = header.unpack_from(mm, 0)
+
+        # (p_offset, p_vaddr) of the loadable segments mapped executable.
+        self.executable_segments: tp.List[tp.Tuple[int, int]] = []
+        for i in range(phnum):
+            fields = program_header.unpack_from(mm, phoff + i * phentsize)
+            if is_64bit:
+                p_type, p_flags, p_offset, p_vaddr = fields
+            else:
+                p_type, p_offset, p_vaddr, _, _, _, p_flags = fields
+            if p_type == _PT_LOAD and p_flags & _PF_X:
+                self.executable_segments.append((p_offset, p_vaddr))
 
-    def __init__(self, address: int, symbol: str):
-        self.address = address
-        self.symbol = symbol
-        self._cleaned_symbol = None
+        if shoff == 0:
+            self.sections: tp.List[_ElfSection] = []
+            return
+        # the real section count and the index of the section names live in the first section header
+        # when they do not fit in the ELF header.
+        _, _, _, _, _, size0, link0, *_ = self._section_header.unpack_from(mm, shoff)
+        if shnum == 0:
+            shnum = size0
+        if shstrndx == _SHN_XINDEX:
+            shstrndx = link0
 
-    def simplified_symbol(self) -> str:
-        if self._cleaned_symbol is None:
-            self._cleaned_symbol = _cleanup_symbol(self.symbol)
-        return self._cleaned_symbol
+        raw_sections = [
+            self._section_header.unpack_from(mm, shoff + i * self._section_header.size) for i in range(shnum)
+        ]
+        # sh_name, sh_type, sh_flags, sh_addr, sh_offset, sh_size, sh_link, ...
+        names_offset = raw_sections[shstrndx][4]
+        self.sections = [
+            _ElfSection(
+                name=self._read_str(names_offset + raw[0]),
+                type=raw[1],
+                addr=raw[3],
+                offset=raw[4],
+                size=raw[5],
+                link=raw[6],
+            )
+            for raw in raw_sections
+        ]
+
+    def _read_str(self, offset: int) -> str:
+        return self._mm[offset:self._mm.find(b'\0', offset)].decode(errors='replace')
 
+    def find_section(self, name: str) -> tp.Optional[_ElfSection]:
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
 
-# Use readelf to get the start virtual memory address of the specific object before linked.
-def _find_object_start_vma_before_linked(filepath: Path) -> int:
+    def _version_names(self) -> tp.Tuple[tp.Optional[_ElfSection], tp.Dict[int, tp.Tuple[str, bool]]]:
+        """
+        Return the .gnu.version section and the version index -> (name, is_defined_here) map
+        of .gnu.version_d and .gnu.version_r.
+        """
+        versym = next((s for s in self.sections if s.type == _SHT_GNU_VERSYM), None)
+        versions: tp.Dict[int, tp.Tuple[str, bool]] = {}
+        for section in self.sections:
+            if section.type not in (_SHT_GNU_VERDEF, _SHT_GNU_VERNEED):
+                continue
+            strtab = self.sections[section.link]
+            offset = section.offset
+            while True:
+                if section.type == _SHT_GNU_VERDEF:
+                    # Elf_Verdef: vd_version, vd_flags, vd_ndx, vd_cnt, vd_hash, vd_aux, vd_next
+                    # Elf_Verdaux: vda_name, vda_next
+                    _, _, ndx, cnt, _, aux, next_offset = struct.unpack_from(
+                        f'{self._endian}HHHHIII', self._mm, offset
+                    )
+                    if cnt:
+                        vda_name, = struct.unpack_from(f'{self._endian}I', self._mm, offset + aux)
+                        versions[ndx] = (self._read_str(strtab.offset + vda_name), True)
+                else:
+                    # Elf_Verneed: vn_version, vn_cnt, vn_file, vn_aux, vn_next
+                    # Elf_Vernaux: vna_hash, vna_flags, vna_other, vna_name, vna_next
+                    _, cnt, _, aux, next_offset = struct.unpack_from(f'{self._endian}HHIII', self._mm, offset)
+                    aux_offset = offset + aux
+                    for _ in range(cnt):
+                        _, _, ndx, vna_name, vna_next = struct.unpack_from(
+                            f'{self._endian}IHHII', self._mm, aux_offset
+                        )
+                        versions[ndx] = (self._read_str(strtab.offset + vna_name), False)
+                        aux_offset += vna_next
+                if not next_offset:
+                    break
+                offset += next_offset
+        return versym, versions
+
+    def defined_symbols(self, section: _ElfSection) -> tp.Iterator[tp.Tuple[int, str, str]]:
+        """
+        Yield (address, mangled name, version suffix) of the defined symbols in a symbol table section,
+        the way nm lists them. Only symbols of the dynamic symbol table get a "@VERSION" / "@@VERSION" suffix.
+        """
+        versym, versions = self._version_names() if section.type == _SHT_DYNSYM else (None, {})
+        strtab_offset = self.sections[section.link].offset
+        count = section.size // self._symbol.size
+        symbols = self._symbol.iter_unpack(self._mm[section.offset:section.offset + count * self._symbol.size])
+        for i, fields in enumerate(symbols):
+            if self._is_64bit:
+                st_name, st_info, st_shndx, st_value = fields
+            else:
+                st_name, st_value, st_info, st_shndx = fields
+            # the first entry is always the null symbol, section and file symbols are debugging only.
+            if i == 0 or st_shndx == _SHN_UNDEF or st_info & 0xf in (_STT_SECTION, _STT_FILE):
+                continue
+            name = self._read_str(strtab_offset + st_name)
+            if _MAPPING_SYMBOL.fullmatch(name):
+                continue
+            suffix = ''
+            if versym is not None:
+                ver, = struct.unpack_from(f'{self._endian}H', self._mm, versym.offset + 2 * i)
+                version, is_defined_here = versions.get(ver & ~_VERSYM_HIDDEN, (None, False))
+                # the symbol which defines the version itself is listed without suffix,
+                # "@@" marks the default version defined by this object.
+                if version is not None and (ver & ~_VERSYM_HIDDEN) > 1 and version != name:
+                    suffix = f'@@{version}' if is_defined_here and not ver & _VERSYM_HIDDEN else f'@{version}'
+            yield st_value, name, suffix
+
+
+# Demangle C++ symbols with a single c++filt process, a "@VERSION" suffix in the name is kept as is.
+def _demangle_symbols(names: tp.List[str]) -> tp.List[str]:
+    if not names:
+        return []
+    base_names = []
+    suffixes = []
+    for name in names:
+        base, at, version = name.partition('@')
+        base_names.append(base)
+        suffixes.append(at + version)
     proc_res = subprocess.run(
-        ['readelf', '-W', '-S', filepath.absolute()], text=True, check=True, capture_output=True
+        # -i drops the implementation details, e.g. std::ostream stays std::ostream like with nm -C.
+        ['c++filt', '-i', '--no-recurse-limit'],
+        input='\n'.join(base_names) + '\n',
+        text=True,
+        check=True,
+        capture_output=True
     )
-    m = re.search(r'\.text\s+PROGBITS\s+([0-9a0-f]+)\s+([0-9a-f]+)', proc_res.stdout)
-    if m:
-        return int(m.group(1), 16) - int(m.group(2), 16)
-    
-    return 0
-
-# Use nm to get the virtual address and function symbols of the specific object before linked.
-def _find_object_all_symbols_sorted(filepath: Path) -> tp.List[Symbol]:
-    proc_output= ''
-    # fallback to dynamic symbols (for libraries)
-    for extra_args in ([], ['-D']):
-        proc_res = subprocess.run(
-            [
-                'nm',
-                '-C',
-                '-n',
-                '--defined-only',
-                '--no-recurse-limit',
-                *extra_args,
-                filepath.absolute(),
-            ],
-            text=True,
-            check=True,
-            capture_output=True
-        )
-        if proc_res.stdout.strip():
-            proc_output = proc_res.stdout
-            break
-    
+    demangled = proc_res.stdout.split('\n')[:-1]
+    assert len(demangled) == len(names), 'c++filt output does not match its input'
+
+    return [base + suffix for base, suffix in zip(demangled, suffixes)]
+
+# Read the object file once to get the virtual address and function symbols before linked,
+# and the start virtual memory address of the object before linked (segment address - file offset).
+# The symbols are returned as two parallel sequences: addresses (sorted) and demangled symbol names.
+def _read_object_symbols(filepath: Path) -> tp.Tuple[array.array, tp.List[str], int]:
+    with filepath.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        elf = _ElfFile(mm)
+
+        # the executable mapping of the process is the executable load segment, fallback to .text
+        # if there is no program header.
+        if elf.executable_segments:
+            offset, vaddr = elf.executable_segments[0]
+            start_vma = vaddr - offset
+        else:
+            text = elf.find_section('.text')
+            start_vma = text.addr - text.offset if text is not None else 0
+
+        symbols: tp.List[tp.Tuple[int, str, str]] = []
+        # fallback to dynamic symbols (for stripped libraries)
+        for symtab_type in (_SHT_SYMTAB, _SHT_DYNSYM):
+            for section in elf.sections:
+                if section.type == symtab_type:
+                    symbols.extend(elf.defined_symbols(section))
+            if symbols:
+                break
+
+    # sorted by address, then by the mangled name like nm -n, the symbol table order is kept for equal names.
+    symbols.sort(key=lambda symbol: symbol[:2])
+    addrs = array.array('Q', (address for address, _, _ in symbols))
+    names = [
+        name + suffix for name, (_, _, suffix) in zip(_demangle_symbols([name for _, name, _ in symbols]), symbols)
+    ]
+
+    return addrs, names, start_vma
+
+
+# Symbols of object files keyed by path, mtime and size. The on-disk cache lets repeated runs
+# against the same binaries skip reading them entirely, bump the version when the cached data changes.
+_SYMBOL_CACHE_VERSION = 5
+_loaded_object_symbols: tp.Dict[str, tp.Tuple[array.array, tp.List[str], int]] = {}
+
+def _symbol_cache_dir() -> tp.Optional[Path]:
+    """
+    Return the per-user symbol cache directory, or None if it can not be used safely.
+    """
+    try:
+        cache_home = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache')
+        cache_dir = cache_home / 'gperf2flamegraph' / 'symbols'
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        stat = cache_dir.stat()
+    except (OSError, RuntimeError):
+        return None
+    # only trust a directory which belongs to the current user and nobody else can write to.
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        return None
+    return cache_dir
+
+def _read_symbol_cache(cache_file: Path) -> tp.Tuple[array.array, tp.List[str], int]:
+    with cache_file.open('r') as f:
+        data = json.load(f)
+    names = data['names']
+    start_vma = data['start_vma']
+    addrs = array.array('Q', data['addrs'])
+    if (
+        not isinstance(names, list)
+        or not isinstance(start_vma, int)
+        or len(names) != len(addrs)
+        or not all(isinstance(name, str) for name in names)
+    ):
+        raise ValueError(f'Invalid symbol cache file {cache_file}')
+    return addrs, names, start_vma
+
+def _load_object_symbols(filepath: Path) -> tp.Tuple[array.array, tp.List[str], int]:
+    """
+    Return the sorted symbol addresses, the symbol names and the start vma before linked of the object file.
+    """
+    stat = filepath.stat()
+    key = f'{_SYMBOL_CACHE_VERSION}:{filepath.absolute()}:{stat.st_mtime_ns}:{stat.st_size}'
+    if key in _loaded_object_symbols:
+        return _loaded_object_symbols[key]
+
+    cache_dir = _symbol_cache_dir()
+    cache_file = cache_dir / f'{hashlib.sha1(key.encode()).hexdigest()}.json' if cache_dir else None
+    try:
+        if cache_file is None:
+            raise FileNotFoundError('no symbol cache directory')
+        addrs, names, start_vma = _read_symbol_cache(cache_file)
+    except (OSError, ValueError, TypeError, KeyError, OverflowError):
+        addrs, names, start_vma = _read_object_symbols(filepath)
+        # the cache is best effort, write to a temporary file first so readers never see a partial one.
+        if cache_file is not None:
+            try:
+                tmp_file = cache_file.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+                with tmp_file.open('w') as f:
+                    json.dump({'addrs': addrs.tolist(), 'names': names, 'start_vma': start_vma}, f)
+                os.replace(tmp_file, cache_file)
+            except OSError:
+                pass
+
+    _loaded_object_symbols[key] = (addrs, names, start_vma)
+    return addrs, names, start_vma
+
+
+def _find_symbol_indices(addrs: array.array, sorted_pcs: tp.List[int], correction: int) -> tp.List[int]:
+    """
+    Return the index of the symbol containing each pc in addrs (-1 if it is before the first symbol).
+    correction converts a pc to the address before linked.
+    """
     result = []
-    for line in proc_output.splitlines():
-        fields = line.rstrip().split(None, 2)
-        symbol = fields[2]
-        result.append(Symbol(int(fields[0], 16), symbol))
-    result = sorted(result, key=lambda x: x.address)
+    append = result.append
+    bisect_right = bisect.bisect_right
+    num_addrs = len(addrs)
+    # the pcs are sorted, so the index only moves forward and the bisect is skipped
+    # while the pcs stay inside the current symbol, i.e. below the next symbol's address.
+    idx = -1
+    next_addr = addrs[0] if num_addrs else None
+    for pc in sorted_pcs:
+        addr = pc + correction
+        if next_addr is not None and addr >= next_addr:
+            idx = bisect_right(addrs, addr, idx + 1) - 1
+            next_addr = addrs[idx + 1] if idx + 1 < num_addrs else None
+        append(idx)
 
     return result
 
@@ -104,14 +360,19 @@ class SymbolResolver:
         obj_path: Path
         is_executable: bool
 
-        all_symbols_sorted: tp.List[Symbol]
-        all_addrs_sorted: tp.List[int]
+        # symbols of the object file, addrs is sorted and the others are parallel to it.
+        addrs: array.array
+        names: tp.List[str]
+        # simplified names, filled lazily.
+        cleaned: tp.List[tp.Optional[str]]
         obj_start_vma: int
 
     _objects: tp.List[MappedObject]
 
     def __init__(self, executable: Path, proc_mapped_objects: str, *, executable_only: bool) -> None:
         self._objects = []
+        # (start_address, end_address, offset, obj_path, is_executable) of executable mappings.
+        mapped: tp.List[tp.Tuple[int, int, int, Path, bool]] = []
 
         # Text list of mapped objects of cpu profiler result.
         # start_address-end_address rwxp offset dev:dev inode filepath
@@ -136,38 +397,67 @@ class SymbolResolver:
             if not obj_path.exists() or not os.access(obj_path.absolute(), os.R_OK):
                 continue
 
-            all_symbols_sorted = _find_object_all_symbols_sorted(obj_path)
+            mapped.append(
+                (int(addr_fileds[0], 16), int(addr_fileds[1], 16), int(fields[2], 16), obj_path, is_executable)
+            )
+
+        # symbols are loaded once per object file (the same file can be mapped several times),
+        # and the c++filt subprocesses of different files are waited on concurrently.
+        obj_paths = list(dict.fromkeys(obj_path for _, _, _, obj_path, _ in mapped))
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = {obj_path: executor.submit(_load_object_symbols, obj_path) for obj_path in obj_paths}
+            all_symbols = {obj_path: future.result() for obj_path, future in futures.items()}
+        all_cleaned = {obj_path: [None] * len(names) for obj_path, (_, names, _) in all_symbols.items()}
 
+        for start_address, end_address, offset, obj_path, is_executable in mapped:
+            addrs, names, obj_start_vma = all_symbols[obj_path]
             # every mapped object has its specific address and symbos information.
             self._objects.append(
                 self.MappedObject(
-                    start_address=int(addr_fileds[0], 16),
-                    end_address=int(addr_fileds[1], 16),
-                    offset=int(fields[2], 16),
+                    start_address=start_address,
+                    end_address=end_address,
+                    offset=offset,
                     obj_path=obj_path,
                     is_executable=is_executable,
-                    all_symbols_sorted=all_symbols_sorted,
-                    all_addrs_sorted=[symbol.address for symbol in all_symbols_sorted],
-                    obj_start_vma=_find_object_start_vma_before_linked(obj_path),
+                    addrs=addrs,
+                    names=names,
+                    cleaned=all_cleaned[obj_path],
+                    obj_start_vma=obj_start_vma,
                 )
             )
 
     # pcs: call stack program counter.
     def resolve_symbols_batch(self, pcs: set[int], *, simplify_symbol: bool = False, annotate_libname: bool = False) -> tp.Dict[int, str]:
         result: tp.Dict[int, str] = {}
+        sorted_pcs = sorted(pcs)
         for obj in self._objects:
-            for pc in pcs:
-                if not obj.start_address <= pc < obj.end_address:
+            # the pcs inside this object are a contiguous run of sorted_pcs.
+            lo = bisect.bisect_left(sorted_pcs, obj.start_address)
+            hi = bisect.bisect_left(sorted_pcs, obj.end_address, lo)
+            obj_pcs = sorted_pcs[lo:hi]
+            sym_indices = _find_symbol_indices(
+                obj.addrs, obj_pcs, obj.offset + obj.obj_start_vma - obj.start_address
+            )
+            # symbol index -> final symbol string, nearby pcs usually fall into the same function.
+            sym_cache: tp.Dict[int, str] = {}
+            for pc, idx in zip(obj_pcs, sym_indices):
+                if idx < 0:
                     continue
-                addr_before_linked = pc - obj.start_address + obj.offset+ obj.obj_start_vma
-                idx = bisect.bisect_right(obj.all_addrs_sorted, addr_before_linked) - 1
-                if 0 <= idx < len(obj.all_symbols_sorted):
-                    sym = obj.all_symbols_sorted[idx]
-                    sym_str = sym.simplified_symbol() if simplify_symbol else sym.symbol
+                sym_str = sym_cache.get(idx)
+                if sym_str is None:
+                    if simplify_symbol:
+                        sym_str = obj.cleaned[idx]
+                        if sym_str is None:
+                            sym_str = obj.cleaned[idx] = _cleanup_symbol(obj.names[idx])
+                    else:
+                        sym_str = obj.names[idx]
                     if annotate_libname and not obj.is_executable:
                         sym_str += f' [{obj.obj_path.name}]'
-                    result[pc] = sym_str
-        
+                    # equal symbols of different objects (or mappings) become the same object,
+                    # so their hash is computed once during aggregation.
+                    sym_str = sym_cache[idx] = sys.intern(sym_str)
+                result[pc] = sym_str
+
         return result
     
 
@@ -178,17 +468,32 @@ class FlamegraphData:
     
     def __init__(self, stacks: tp.Dict[str, int], *, default_flamegraph_args: tp.List[str] = []) -> None:
         self._default_flamegraph_args = default_flamegraph_args
-        self._data = '\n'.join(f'{s} {c}' for s, c in stacks.items()) + '\n'
+        self._stacks = stacks
+
+    # the folded lines are generated on demand instead of being joined into one big string.
+    def _iter_lines(self) -> tp.Iterator[str]:
+        for s, c in self._stacks.items():
+            yield f'{s} {c}\n'
 
     def write_text_output(self, filepath: Path):
-        filepath.write_text(self._data)
+        with filepath.open('w') as f:
+            f.writelines(self._iter_lines())
 
     def write_svg_ouput(self, filepath: Path, flamegraph_args: tp.List[str] = []):
-        subprocess.run(
-            ['./FlameGraph/flamegraph.pl', *self._default_flamegraph_args, *flamegraph_args],
-            input=self._data,
-            stdout=filepath.open('w'),
-            text=True,
-            check=True
-        )
-        
+        args = ['./FlameGraph/flamegraph.pl', *self._default_flamegraph_args, *flamegraph_args]
+        # stdout goes to the file, so feeding stdin from this thread can not deadlock.
+        with filepath.open('w') as f:
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=f, text=True)
+            try:
+                proc.stdin.writelines(self._iter_lines())
+            except BrokenPipeError:
+                # flamegraph.pl exited early, its exit status is reported below.
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            proc.wait()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args)